@@ -1,10 +1,15 @@
 import ctypes
+import threading
 
 import numpy
-import pyaudio
 
 
 PY_AUDIO = None
+PY_AUDIO_LOCK = threading.Lock()
+
+# from portaudio.h, so that using these doesn't mean loading PortAudio
+PA_INT16 = 0x8
+PA_CONTINUE = 0
 
 SILENCE = b'\0' * 240
 FADE_IN = numpy.linspace(0, 1, num=120)
@@ -12,9 +17,14 @@ FADE_OUT = numpy.linspace(1, 0, num=120)
 
 
 def get_audio():
+    """Return the PyAudio instance, loading PortAudio the first time.
+    Device enumeration can take a while, so callers that know they'll need
+    it may call this early from another thread."""
     global PY_AUDIO
-    if PY_AUDIO is None:
-        PY_AUDIO = pyaudio.PyAudio()
+    with PY_AUDIO_LOCK:
+        if PY_AUDIO is None:
+            import pyaudio
+            PY_AUDIO = pyaudio.PyAudio()
     return PY_AUDIO
 
 
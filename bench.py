@@ -0,0 +1,373 @@
+"""Benchmarks. Run `python3 bench.py <name> [options]`; see BENCHMARKS."""
+
+import collections
+import json
+import multiprocessing
+import socket
+import subprocess
+import sys
+import time
+
+
+def relay_pinger(port, clients, duration, results):
+    """Ping the relay from many sockets at once, counting pongs."""
+    socks = []
+    for i in range(clients):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.setblocking(False)
+        socks.append(sock)
+        enter = {'type': 'enter', 'from': 'bot-{}'.format(sock.getsockname()[1]), 'seq': 0}
+        sock.sendto(json.dumps(enter).encode('ascii'), ('127.0.0.1', port))
+    ping = json.dumps({'type': 'ping', 'from': 'bot', 'seq': 1}).encode('ascii')
+    pongs = 0
+    pong_bytes = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for sock in socks:
+            sock.sendto(ping, ('127.0.0.1', port))
+        for sock in socks:
+            try:
+                while True:
+                    data = sock.recv(65536)
+                    pongs += 1
+                    pong_bytes += len(data)
+            except BlockingIOError:
+                pass
+    results.put((pongs, pong_bytes))
+
+
+def free_udp_port():
+    """A port nothing is bound to, even with SO_REUSEPORT (which a plain
+    bind can't share), such as a relay left over from an earlier run."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('0.0.0.0', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def bench_relay(argv):
+    """Pongs/sec from the relay for 1..N workers."""
+    max_workers = int(argv[0]) if argv else multiprocessing.cpu_count()
+    duration = 5
+    for workers in range(1, max_workers + 1):
+        port = free_udp_port()
+        proc = subprocess.Popen([sys.executable, 'relay.py', '--workers', str(workers), '--port', str(port)])
+        time.sleep(1)
+        results = multiprocessing.Queue()
+        pingers = [
+            multiprocessing.Process(target=relay_pinger, args=(port, 50, duration, results))
+            for _ in range(workers)
+        ]
+        for pinger in pingers:
+            pinger.start()
+        totals = [results.get() for _ in pingers]
+        for pinger in pingers:
+            pinger.join()
+        proc.terminate()
+        proc.wait()
+        pongs = sum(pongs for pongs, _ in totals)
+        pong_bytes = sum(size for _, size in totals)
+        print('{} workers: {:8.0f} pongs/sec {:10.0f} bytes/sec'.format(
+            workers, pongs / duration, pong_bytes / duration))
+
+
+def bench_roster(argv):
+    """Pong bytes with versioned roster deltas vs full lists, with churn,
+    checking that every peer table ends up matching the relay's roster."""
+    import random
+    import net
+    import relay
+
+    clients = int(argv[0]) if argv else 300
+    rounds = 50
+    server = relay.Relay(relay.Store())
+    addrs = [('10.0.{}.{}'.format(i // 250, i % 250), 40000 + i) for i in range(clients)]
+    tables = {}
+    for addr in addrs:
+        server.handle_msg({'type': 'enter', 'from': 'bot-{}'.format(addr[1])}, addr)
+        tables[addr] = net.PeerTable()
+    totals = collections.Counter()
+
+    def ping_all():
+        full_bytes = len(json.dumps({'type': 'pong', 'clients': server.list_clients()}))
+        for addr, table in tables.items():
+            ping = {'type': 'ping', 'version': table.version}
+            if table.cursor:
+                ping['after'] = table.cursor
+            start = time.perf_counter()
+            reply = json.dumps(server.handle_msg(ping, addr))
+            table.update(json.loads(reply))
+            totals['elapsed'] += time.perf_counter() - start
+            totals['delta'] += len(reply)
+            totals['full'] += full_bytes
+            totals['largest'] = max(totals['largest'], len(reply))
+
+    for _ in range(rounds):
+        for addr in random.sample(addrs, clients // 100 + 1):  # churn
+            if addr in server.roster:
+                server.handle_msg({'type': 'leave'}, addr)
+            else:
+                server.handle_msg({'type': 'enter', 'from': 'bot-{}'.format(addr[1])}, addr)
+        ping_all()
+    quiet_rounds = 0
+    while not all(table.names == server.roster for table in tables.values()):
+        assert quiet_rounds < 1000, 'peer tables never converged'
+        ping_all()
+        quiet_rounds += 1
+    pongs = (rounds + quiet_rounds) * clients
+    print('{} clients, {} pongs: {:.1f} us/pong'.format(clients, pongs, totals['elapsed'] / pongs * 1e6))
+    print('full lists: {:8.0f} bytes/pong'.format(totals['full'] / pongs))
+    print('deltas:     {:8.0f} bytes/pong, largest {}'.format(totals['delta'] / pongs, totals['largest']))
+    print('all tables match the relay after {} quiet rounds'.format(quiet_rounds))
+    assert totals['largest'] <= relay.MAX_REPLY_BYTES, 'reply too big for one datagram'
+
+
+def bench_bundle(argv):
+    """End-to-end delay and frame loss for k=1..MAX_BUNDLE, sending real
+    bundles over loopback through Client.broadcast_unreliably."""
+    import net
+
+    frame_size = int(argv[0]) if argv else 40  # 64 kbit/s at 5 ms frames
+    duration = float(argv[1]) if len(argv) > 1 else 5.0  # seconds per k
+    overhead = 28  # IPv4 + UDP headers
+    relay_addr = ('127.0.0.1', free_udp_port())  # nobody there; pings go unanswered
+    sender = net.Client(relay_addr, 'sender')
+    receiver = net.Client(relay_addr, 'receiver')
+    receiver.receive_ping = lambda payload, peer: None  # so pongs can't move the bundle size
+    receiver.set_assoc('sender', ('127.0.0.1', sender.port))
+    sender.set_assoc('receiver', ('127.0.0.1', receiver.port))
+    sender.known_peers.names = {('127.0.0.1', receiver.port): 'receiver'}
+    link = sender.peers['receiver']
+
+    sent = {}  # seq -> time the frame was recorded
+    received = {}  # seq -> first arrival
+    totals = collections.Counter()
+
+    def on_bundle(payloads, peer_name):
+        now = time.time()
+        totals['datagrams'] += 1
+        totals['bytes'] += overhead + len(net.pack_bundle(payloads[0][0], [data for (_, data) in payloads]))
+        for (seq, _) in payloads:
+            received.setdefault(seq, now)
+    receiver.raw_listeners.append(on_bundle)
+
+    frame = bytes(frame_size)
+    frame_time = net.FRAME_MS / 1000
+    print(' k | pkt/s  bytes/s | delay ms: p50   p99   max | frames lost')
+    for k in range(1, net.MAX_BUNDLE + 1):
+        sent.clear()
+        received.clear()
+        totals.clear()
+        start = time.time()
+        for idx in range(int(duration / frame_time)):
+            wait = start + idx * frame_time - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            # pin what bundle_size reads, so this peer gets k frames per datagram
+            (link.rtt, link.rtt_dev, link.loss) = (1.0, (k - 1) * net.FRAME_MS, 0.0)
+            sent[sender.broadcast_seq + 1] = time.time()
+            sender.broadcast_unreliably(frame)
+        time.sleep(0.5)  # let delayed datagrams land
+        link.unsent = 0
+        # the last few frames may still be waiting for their bundle to fill
+        measured = [seq for seq in sent if seq <= sender.broadcast_seq - net.MAX_BUNDLE]
+        delays = sorted(1000 * (received[seq] - sent[seq]) for seq in measured if seq in received)
+        lost = len(measured) - len(delays)
+        print('{:2} | {:5.0f} {:8.0f} | {:13.1f} {:5.1f} {:5.1f} | {:5} ({:.2%})'.format(
+            k, totals['datagrams'] / duration, totals['bytes'] / duration,
+            delays[len(delays) // 2], delays[int(len(delays) * 0.99)], delays[-1],
+            lost, lost / len(measured)))
+
+
+def check_recvstats():
+    """Known answers for util.ReceiveStats on a small window."""
+    import util
+
+    receive_stats = util.ReceiveStats(window=16)
+    top = 1 << 32
+    for seq in (top - 3, top - 2, top - 1):
+        receive_stats.receive(seq, 0.0)
+    assert receive_stats.receive(0, 0.0) == top, 'seq not extended across 2**32'
+    assert receive_stats.receive(1, 0.0) == top + 1
+    assert receive_stats.receive(1, 0.0) is None and receive_stats.duplicates == 1
+    assert receive_stats.receive(top - 15, 0.0) is None and receive_stats.too_old == 1
+    for seq in range(2, 21):
+        if seq not in (5, 6, 7, 12):
+            receive_stats.receive(seq, 0.0)
+    receive_stats.receive(10**6, 0.0)  # settled in bulk, not one seq at a time
+    assert receive_stats.burst_histogram[1] == 1 and receive_stats.burst_histogram[3] == 1
+    assert sum(receive_stats.burst_histogram) == 2, receive_stats.burst_histogram
+    assert receive_stats.loss_run == 10**6 - 21 - (16 - 1)  # all but those still in the window
+    assert receive_stats.lost == 4 + 10**6 - 21
+    assert receive_stats.in_window == 1 and receive_stats.unborn == 0
+
+
+def bench_recvstats(argv):
+    """ns/packet for util.ReceiveStats on a lossy, reordered stream."""
+    import random
+    import util
+
+    check_recvstats()
+    packets = int(argv[0]) if argv else 200000
+    rng = random.Random(1)
+    seqs = []
+    seq = (1 << 32) - packets // 2  # wraps halfway through
+    for _ in range(packets):
+        seq += 1
+        if rng.random() < 0.05:
+            continue  # lost
+        seqs.append(seq % (1 << 32))
+        if rng.random() < 0.01:
+            seqs.append((seq - rng.randint(1, 5)) % (1 << 32))  # late or duplicate
+    arrivals = [idx * 0.005 + rng.random() * 0.002 for idx in range(len(seqs))]
+    receive_stats = util.ReceiveStats()
+    start = time.perf_counter()
+    for seq, arrival in zip(seqs, arrivals):
+        receive_stats.receive(seq, arrival)
+    elapsed = time.perf_counter() - start
+    print('{:.0f} ns/packet'.format(elapsed / len(seqs) * 1e9))
+    print('received {} of {} expected, {} duplicates, {} reordered, jitter {:.2f} ms, recent rate {:.3f}'.format(
+        receive_stats.received, receive_stats.expected, receive_stats.duplicates,
+        receive_stats.reordered, receive_stats.jitter * 1000, receive_stats.receive_rate))
+    print('loss bursts:', receive_stats.burst_histogram)
+    print('reorder distance:', receive_stats.reorder_histogram)
+
+
+STARTUP_CASES = (
+    ('relay', 'import relay'),
+    ('headless bot', "import net; net.Client(('127.0.0.1', 9), 'bot')"),
+    ('client', 'import client'),
+    ('client + audio', 'import client; client.load_audio()'),
+)
+STARTUP_PROBE = """
+import sys, threading, time
+start = time.perf_counter()
+{}
+elapsed = time.perf_counter() - start
+heavy = [name for name in ('numpy', 'opuslib', 'pyaudio') if name in sys.modules]
+print(elapsed, threading.active_count(), ','.join(heavy) or '-')
+"""
+
+
+def bench_startup(argv):
+    """Import/startup time, threads and heavy modules loaded, per process kind."""
+    runs = int(argv[0]) if argv else 5
+    for label, code in STARTUP_CASES:
+        times = []
+        for _ in range(runs):
+            proc = subprocess.run(
+                [sys.executable, '-c', STARTUP_PROBE.format(code)],
+                capture_output=True, text=True,
+            )
+            if proc.returncode:
+                print('{:>15}: failed: {}'.format(label, proc.stderr.strip().splitlines()[-1]))
+                break
+            (elapsed, threads, heavy) = proc.stdout.split()
+            times.append(float(elapsed))
+        else:
+            times.sort()
+            print('{:>15}: {:7.1f} ms median, {} threads, loaded {}'.format(
+                label, times[len(times) // 2] * 1000, threads, heavy))
+
+
+def bench_churn(argv):
+    """Threads and memory of a Player while peers keep reconnecting."""
+    import threading
+    import tracemalloc
+    import opuslib
+    import player
+
+    seconds = int(argv[0]) if argv else 300
+    peers = 8
+    session = 10  # seconds before each peer reconnects under a new name
+    encoder = opuslib.Encoder(24000, 1, opuslib.APPLICATION_RESTRICTED_LOWDELAY)
+    packet = encoder.encode(bytes(240), 120)
+    clock = [0.0]
+    play = player.Player(clock=lambda: clock[0])
+    tracemalloc.start()
+    seq = 0
+    for tick in range(seconds * 200):
+        clock[0] = tick * 0.005
+        seq += 1
+        for peer in range(peers):
+            generation = int((clock[0] + peer * session / peers) / session)
+            play.put_payloads([(seq, packet)], 'peer{}-{}'.format(peer, generation))
+        play.callback(None, 120, None, 0)
+        if tick % 200 == 0:
+            play.housekeep()
+        if tick % (30 * 200) == 0:
+            (current, _) = tracemalloc.get_traced_memory()
+            print('{:4.0f} s: {:3} channels {:3} threads {:6.0f} KiB'.format(
+                clock[0], len(play.channels), threading.active_count(), current / 1024))
+
+
+def stall_latency(directory, recovery):
+    import player
+    import replay
+
+    threshold = player.RECOVERY_THRESHOLD if recovery else float('inf')
+    session = replay.Replay(directory, recovery_threshold=threshold)
+    latencies = []
+
+    def measure(frame):
+        channel = session.player.channels.get('peer')
+        if channel and channel.last_played:
+            latencies.append(max(0, channel.receive_stats.highest - channel.last_played) * 5)
+        else:
+            latencies.append(0)
+    session.listeners.append(measure)
+    session.run()
+    return latencies
+
+
+def bench_stall(argv):
+    """Buffer latency over time through a replayed Wi-Fi stall, with and
+    without burst recovery."""
+    import math
+    import random
+    import tempfile
+    import opuslib
+    import capture
+
+    stall = float(argv[0]) if argv else 0.3  # seconds
+    encoder = opuslib.Encoder(24000, 1, opuslib.APPLICATION_RESTRICTED_LOWDELAY)
+    tone = bytes(b for idx in range(120) for b in int(8000 * math.sin(idx / 120 * 2 * math.pi * 5)).to_bytes(2, 'little', signed=True))
+    directory = tempfile.mkdtemp()
+    recording = capture.Capture(directory)
+    stall_start = 1.0
+    rng = random.Random(1)
+    for seq in range(1, 800):
+        arrival = 100 + seq * 0.005 + rng.random() * 0.002
+        if stall_start <= seq * 0.005 < stall_start + stall:
+            arrival = 100 + stall_start + stall  # held up, then all at once
+        recording.put_payloads([(seq, encoder.encode(tone, 120))], 'peer', arrival)
+    recording.stop()
+    with_recovery = stall_latency(directory, True)
+    without = stall_latency(directory, False)
+    print(' time | latency, ms (# with recovery, . without)')
+    for idx in range(0, len(with_recovery), 10):
+        (fast, slow) = (with_recovery[idx], without[idx])
+        bar = ['#' if col * 10 < fast else ' ' for col in range(max(fast, slow) // 10 + 1)]
+        for col in range(fast // 10, slow // 10):
+            bar[col] = '.'
+        print('{:5.2f} | {:4} {:4} {}'.format(idx * 0.005, fast, slow, ''.join(bar)))
+
+
+BENCHMARKS = {
+    'churn': bench_churn,
+    'bundle': bench_bundle,
+    'relay': bench_relay,
+    'recvstats': bench_recvstats,
+    'roster': bench_roster,
+    'stall': bench_stall,
+    'startup': bench_startup,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print('usage: bench.py {{{}}} [options]'.format(','.join(sorted(BENCHMARKS))))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](sys.argv[2:])
@@ -0,0 +1,229 @@
+"""Session capture: every received Opus packet, per peer, in Ogg/Opus.
+
+For each peer, <name>.opus holds each seq's packet once, in seq order, so
+it plays as a normal Opus stream. <name>.idx holds one INDEX_RECORD per
+copy received, duplicates and all: arrival time, seq, and the number of
+the datagram it arrived in. Records are grouped by seq, in the same order
+as the stream, and the first record of each seq goes with the next packet.
+
+A seq is written once HOLD_FRAMES later seqs have arrived, and copies that
+arrive after that are left out of both files (but counted in `late`)."""
+
+import collections
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+import util
+
+
+FLUSH_INTERVAL = 0.5
+INDEX_RECORD = struct.Struct('<dII')
+HOLD_FRAMES = 200  # how far out of order a packet may arrive and still be captured
+SAMPLES_PER_FRAME = 240  # Ogg/Opus granule positions count at 48 kHz
+PRE_SKIP = 120  # restricted low-delay encoder lookahead, at 48 kHz
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04c11db7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xffffffff)
+    return table
+
+CRC_TABLE = _crc_table()
+
+
+def ogg_crc(data):
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xffffffff) ^ CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+def safe_name(name):
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+class OggWriter:
+    """Writes one logical Ogg/Opus stream of 5 ms, 24 kHz mono packets."""
+
+    BOS = 0x02
+    EOS = 0x04
+
+    def __init__(self, path):
+        self.fh = open(path, 'wb')
+        self.serial = zlib.crc32(path.encode())
+        self.page_seq = 0
+        self.granule = 0  # samples decoded so far, pre-skip included (RFC 7845)
+        head = b'OpusHead' + struct.pack('<BBHIhB', 1, 1, PRE_SKIP, 24000, 0, 0)
+        vendor = b'opusjam'
+        tags = b'OpusTags' + struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', 0)
+        self.write_page([head], 0, OggWriter.BOS)
+        self.write_page([tags], 0)
+
+    def write_page(self, packets, granule, flags=0):
+        lacing = bytearray()
+        for packet in packets:
+            lacing.extend(b'\xff' * (len(packet) // 255))
+            lacing.append(len(packet) % 255)
+        header = struct.pack(
+            '<4sBBqIIIB', b'OggS', 0, flags, granule, self.serial, self.page_seq, 0, len(lacing),
+        ) + bytes(lacing)
+        page = bytearray(header + b''.join(packets))
+        struct.pack_into('<I', page, 22, ogg_crc(page))
+        self.fh.write(page)
+        self.page_seq += 1
+
+    def write(self, packets, final=False):
+        """Write packets as as many pages as their lacing needs."""
+        page = []
+        segments = 0
+        for packet in packets:
+            needed = len(packet) // 255 + 1
+            if page and segments + needed > 255:
+                self.write_page(page, self.granule)
+                page = []
+                segments = 0
+            page.append(packet)
+            segments += needed
+            self.granule += SAMPLES_PER_FRAME
+        if page or final:
+            self.write_page(page, self.granule, OggWriter.EOS if final else 0)
+
+    def close(self):
+        self.write([], final=True)
+        self.fh.close()
+
+
+def read_ogg_packets(path):
+    """Yield the packets of an Ogg stream written by OggWriter."""
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    idx = 0
+    partial = b''
+    while idx < len(data):
+        (magic, _, _, _, _, _, _, nsegs) = struct.unpack_from('<4sBBqIIIB', data, idx)
+        if magic != b'OggS':
+            raise ValueError('bad Ogg page at byte {}'.format(idx))
+        lacing = data[idx + 27 : idx + 27 + nsegs]
+        idx += 27 + nsegs
+        for size in lacing:
+            partial += data[idx : idx + size]
+            idx += size
+            if size < 255:
+                yield partial
+                partial = b''
+
+
+def read_capture(directory, name):
+    """Return [(arrival time, seq, datagram number, packet)] for one peer,
+    grouped by seq."""
+    base = os.path.join(directory, name)
+    packets = read_ogg_packets(base + '.opus')
+    next(packets)  # OpusHead
+    next(packets)  # OpusTags
+    with open(base + '.idx', 'rb') as fh:
+        index = fh.read()
+    records = []
+    last_seq = packet = None
+    for record in INDEX_RECORD.iter_unpack(index):
+        if record[1] != last_seq:
+            packet = next(packets, None)
+            if packet is None:
+                break  # cut short, e.g. by a crash
+            last_seq = record[1]
+        records.append(record + (packet,))
+    return records
+
+
+def load_captures(directory):
+    """Return {peer name: read_capture(...)} for a capture directory."""
+    return {
+        filename[:-len('.idx')]: read_capture(directory, filename[:-len('.idx')])
+        for filename in sorted(os.listdir(directory))
+        if filename.endswith('.idx')
+    }
+
+
+class Capture:
+    """Raw listener that records received packets in the background.
+
+    put_payloads only appends to a deque; a daemon thread sorts whatever
+    has accumulated every FLUSH_INTERVAL, and writes out the seqs that are
+    HOLD_FRAMES behind the newest."""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.queue = collections.deque()
+        self.files = {}  # peer name -> (OggWriter, index file)
+        self.held = collections.defaultdict(dict)  # peer name -> {seq: (packet, [index records])}
+        self.newest = {}  # peer name -> highest seq received
+        self.written = {}  # peer name -> highest seq written
+        self.datagrams = 0
+        self.late = 0
+        self.stopped = threading.Event()
+        self.thread = util.start_daemon(self.run)
+
+    def put_payloads(self, payloads, peer_name, arrival=None):
+        self.queue.append((time.time() if arrival is None else arrival, peer_name, payloads))
+
+    def run(self):
+        while not self.stopped.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self, final=False):
+        while self.queue:
+            (arrival, peer_name, payloads) = self.queue.popleft()
+            self.datagrams += 1
+            held = self.held[peer_name]
+            written = self.written.get(peer_name, -1)
+            for (seq, data) in payloads:
+                if seq <= written:
+                    self.late += 1
+                    continue
+                record = INDEX_RECORD.pack(arrival, seq, self.datagrams)
+                if seq in held:
+                    held[seq][1].append(record)
+                else:
+                    held[seq] = (data, [record])
+                    self.newest[peer_name] = max(self.newest.get(peer_name, seq), seq)
+        for peer_name, held in self.held.items():
+            if not held:
+                continue
+            limit = self.newest[peer_name] - (0 if final else HOLD_FRAMES)
+            ready = sorted(seq for seq in held if seq <= limit)
+            if not ready:
+                continue
+            packets = []
+            index = bytearray()
+            for seq in ready:
+                (data, records) = held.pop(seq)
+                packets.append(data)
+                index.extend(b''.join(records))
+            (writer, index_fh) = self.get_files(peer_name)
+            writer.write(packets)
+            index_fh.write(index)
+            self.written[peer_name] = ready[-1]
+
+    def get_files(self, peer_name):
+        files = self.files.get(peer_name)
+        if not files:
+            base = os.path.join(self.directory, safe_name(peer_name))
+            files = self.files[peer_name] = (OggWriter(base + '.opus'), open(base + '.idx', 'wb'))
+        return files
+
+    def stop(self, block=True):
+        self.stopped.set()
+        if block:
+            self.thread.join()
+        self.flush(final=True)
+        for (writer, index_fh) in self.files.values():
+            writer.close()
+            index_fh.close()
@@ -1,10 +1,18 @@
 import time
 
-import audio
+import capture
 import logorrhea
 import net
-import player
-import recorder
+import util
+
+
+def load_audio():
+    """Load numpy, Opus and PortAudio, which can take a while; headless
+    clients never call this."""
+    import audio
+    import player
+    import recorder
+    audio.get_audio()
 
 
 if __name__ == '__main__':
@@ -15,6 +23,8 @@ if __name__ == '__main__':
     except ModuleNotFoundError:
         pass
     logging.basicConfig(level=20)
+    if '--silent' not in sys.argv:
+        util.start_daemon(load_audio)  # while the user types
     print('enter your name/alias: ', end='')
     name = '{}-{}'.format(input(), str(time.time())[-3:])
     print('enter relay server address: ', end='')
@@ -29,11 +39,21 @@ if __name__ == '__main__':
         sys.exit(1)
     print("connected to relay at", relay_ip)
     units = []
+    if '--capture' in sys.argv:
+        cap = capture.Capture(sys.argv[sys.argv.index('--capture') + 1])
+        cli.raw_listeners.append(cap.put_payloads)
+        units.append(cap)
     if '--silent' not in sys.argv:
+        import player
         play = player.Player()
         play.start()
         cli.raw_listeners.append(play.put_payloads)
         units.append(play)
+        if '--multitrack' in sys.argv:
+            import multitrack
+            tracks = multitrack.MultitrackWriter(sys.argv[sys.argv.index('--multitrack') + 1])
+            play.tap = tracks.write
+            units.append(tracks)
     broadcast = getattr(cli, 'broadcast_unreliably' if '--unreliable' in sys.argv else 'broadcast')
     rec = None
     try:
@@ -44,6 +64,7 @@ if __name__ == '__main__':
                 if rec:
                     print("already recording")
                     continue
+                import recorder
                 rec = recorder.Recorder()
                 rec.start()
                 rec.listeners.append(broadcast)
@@ -57,6 +78,12 @@ if __name__ == '__main__':
                 rec = None
             elif cmd == 'log':
                 logorrhea.start_thread()
+            elif cmd == 'deadlines':
+                with open('deadlines.txt', 'w') as fh:
+                    for unit in units:
+                        if hasattr(unit, 'monitor'):
+                            print(unit.monitor.report())
+                            unit.monitor.dump(fh)
             elif cmd.startswith('tempo '):
                 bpm = int(cmd.split()[1])
                 cli.propose_tempo(bpm)
@@ -0,0 +1,145 @@
+"""Timing for audio callbacks, which must finish within their frame.
+
+Monitor.wrap(callback) times every call, keeps a duration histogram and
+counts PortAudio status flags. A watchdog thread, woken as each call
+starts, checks back once `threshold` of the budget has gone by, and if
+the call is still running it snapshots every thread's stack, so a glitch
+can be pinned on whoever held the GIL at the time. Between calls it
+sleeps rather than polls, and stop() ends it."""
+
+import collections
+import sys
+import threading
+import time
+import traceback
+
+import stats
+import util
+
+
+# PortAudio callback status flags, as in pyaudio
+STATUS_FLAGS = (
+    (0x1, 'input underflow'),
+    (0x2, 'input overflow'),
+    (0x4, 'output underflow'),
+    (0x8, 'output overflow'),
+    (0x10, 'priming output'),
+)
+BINS = 40  # histogram resolution is budget / (BINS / 2); the last bin is overflow
+STACK_LIMIT = 12
+
+
+Sample = collections.namedtuple('Sample', ['time', 'elapsed', 'stacks'])
+
+
+class Monitor:
+    def __init__(self, name, budget=0.005, threshold=0.8, ring=64):
+        self.name = name
+        self.budget = budget
+        self.threshold = threshold
+        self.bin_width = budget * 2 / BINS
+        self.histogram = [0] * (BINS + 1)
+        self.calls = 0
+        self.misses = 0
+        self.worst = 0.0
+        self.status = collections.Counter()
+        self.samples = collections.deque(maxlen=ring)
+        self.running_since = None  # start of the call in progress
+        self.watched = None  # start of the last call the watchdog checked
+        self.started = threading.Event()  # set as each call starts
+        self.stopped = False
+        self.watchdog = None
+
+    def wrap(self, callback):
+        if not self.watchdog:
+            self.stopped = False
+            self.watchdog = util.start_daemon(self.watch)
+
+        def timed(in_data, frame_count, time_info, status):
+            start = self.running_since = time.perf_counter()
+            self.started.set()
+            try:
+                return callback(in_data, frame_count, time_info, status)
+            finally:
+                self.running_since = None
+                self.record(time.perf_counter() - start, status)
+        return timed
+
+    def record(self, elapsed, status):
+        self.calls += 1
+        self.histogram[min(int(elapsed / self.bin_width), BINS)] += 1
+        if elapsed > self.worst:
+            self.worst = elapsed
+        if elapsed > self.budget:
+            self.misses += 1
+            stats.COUNT('late ' + self.name)
+        if status:
+            for flag, flag_name in STATUS_FLAGS:
+                if status & flag:
+                    self.status[flag_name] += 1
+            stats.COUNT('xrun ' + self.name)
+
+    def watch(self):
+        # A thread holding the GIL delays this by up to sys.getswitchinterval().
+        limit = self.budget * self.threshold
+        while True:
+            self.started.wait()
+            self.started.clear()
+            if self.stopped:
+                return
+            start = self.running_since
+            if start in (None, self.watched):
+                continue
+            self.watched = start
+            wait = start + limit - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            if self.running_since == start:
+                self.sample(time.perf_counter() - start)
+
+    def stop(self):
+        """End the watchdog, once the wrapped callback won't run again."""
+        self.stopped = True
+        self.started.set()
+        if self.watchdog:
+            self.watchdog.join()
+            self.watchdog = None
+
+    def sample(self, elapsed):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        stacks = [
+            (names.get(ident, str(ident)), traceback.extract_stack(frame, limit=STACK_LIMIT))
+            for ident, frame in sys._current_frames().items()
+            if ident != own
+        ]
+        self.samples.append(Sample(time.time(), elapsed, stacks))
+
+    def percentile(self, fraction):
+        """Upper edge of the histogram bin holding the given fraction."""
+        target = fraction * self.calls
+        total = 0
+        for idx, count in enumerate(self.histogram):
+            total += count
+            if total >= target:
+                return (idx + 1) * self.bin_width
+        return self.worst
+
+    def report(self):
+        if not self.calls:
+            return '{}: no callbacks'.format(self.name)
+        lines = ['{}: {} callbacks, {} over {:.1f} ms, worst {:.2f} ms, p50 <{:.2f} ms, p99 <{:.2f} ms'.format(
+            self.name, self.calls, self.misses, self.budget * 1000, self.worst * 1000,
+            self.percentile(0.5) * 1000, self.percentile(0.99) * 1000,
+        )]
+        for flag_name, count in sorted(self.status.items()):
+            lines.append('  {}: {}'.format(flag_name, count))
+        return '\n'.join(lines)
+
+    def dump(self, fh):
+        """Write the sampled stacks, oldest first."""
+        for sample in self.samples:
+            fh.write('=== {} {:.3f} running {:.2f} ms\n'.format(self.name, sample.time, sample.elapsed * 1000))
+            for thread_name, stack in sample.stacks:
+                fh.write('--- {}\n'.format(thread_name))
+                fh.write(''.join(stack.format()))
@@ -0,0 +1,152 @@
+"""Multitrack session recording, as heard by this listener.
+
+Track 0 is the mix; each peer gets the next free track the first time it
+plays. All tracks are aligned by playout sample index, so a peer who joins
+late starts with silence. Samples go straight into a memory-mapped,
+interleaved 16-bit WAV file (RF64 once it outgrows 4 GiB), which a
+background thread extends in CHUNK_SAMPLES steps well ahead of playout,
+and unmaps again once playout is a chunk past them.
+
+Peers beyond the last track aren't recorded; stop() logs who they were."""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+
+import numpy
+
+import audio
+import util
+
+
+RATE = 24000
+CHUNK_SAMPLES = 120 * mmap.ALLOCATIONGRANULARITY  # about 20 s
+CHUNKS_AHEAD = 2
+HEADER_SIZE = max(mmap.ALLOCATIONGRANULARITY, 4096)  # data starts page-aligned
+
+
+class MultitrackWriter:
+    def __init__(self, path, tracks=8):
+        self.path = path
+        self.tracks = tracks
+        self.frame_bytes = 2 * tracks
+        self.chunk_bytes = CHUNK_SAMPLES * self.frame_bytes
+        self.fh = open(path, 'w+b')
+        self.fh.write(self.header(0))
+        self.fh.flush()
+        self.maps = []  # None once unmapped
+        self.chunks = []  # one (CHUNK_SAMPLES, tracks) int16 view per chunk, or None
+        self.names = {'mix': 0}  # peer name -> track
+        self.untracked = set()  # peers that found no free track
+        self.end = 0  # samples written
+        self.dropped = 0  # frames that arrived before their chunk was mapped
+        self.grow_event = threading.Event()
+        self.stopped = False
+        self.grow()
+        self.thread = util.start_daemon(self.run)
+
+    def header(self, samples):
+        data_size = samples * self.frame_bytes
+        riff_size = HEADER_SIZE - 8 + data_size
+        if riff_size > 0xffffffff:
+            riff = struct.pack('<4sI4s', b'RF64', 0xffffffff, b'WAVE')
+            ds64 = struct.pack('<4sIQQQI', b'ds64', 28, riff_size, data_size, samples, 0)
+            data_size = 0xffffffff
+        else:
+            riff = struct.pack('<4sI4s', b'RIFF', riff_size, b'WAVE')
+            ds64 = struct.pack('<4sI', b'JUNK', 28) + bytes(28)  # room for ds64
+        fmt = struct.pack(
+            '<4sIHHIIHH', b'fmt ', 16, 1, self.tracks, RATE,
+            RATE * self.frame_bytes, self.frame_bytes, 16,
+        )
+        head = riff + ds64 + fmt
+        pad = struct.pack('<4sI', b'JUNK', HEADER_SIZE - len(head) - 16)
+        head += pad + bytes(HEADER_SIZE - len(head) - len(pad) - 8)
+        return head + struct.pack('<4sI', b'data', data_size)
+
+    def grow(self):
+        """Extend the file and map chunks until CHUNKS_AHEAD are unused, and
+        unmap those that playout has left a whole chunk behind.
+
+        Each time it maps a chunk, it also brings the header's sizes up to
+        what has been written, so a crash loses at most a chunk or so."""
+        end = self.end
+        for chunk_idx in range(end // CHUNK_SAMPLES - 1):
+            if self.chunks[chunk_idx] is None:
+                continue
+            self.chunks[chunk_idx] = None  # before closing, as the view pins the map
+            self.maps[chunk_idx].close()
+            self.maps[chunk_idx] = None
+        grown = False
+        while len(self.chunks) <= end // CHUNK_SAMPLES + CHUNKS_AHEAD:
+            offset = HEADER_SIZE + len(self.chunks) * self.chunk_bytes
+            size = offset + self.chunk_bytes
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self.fh.fileno(), offset, self.chunk_bytes)
+            else:
+                self.fh.truncate(size)
+            mapped = mmap.mmap(self.fh.fileno(), self.chunk_bytes, offset=offset)
+            self.maps.append(mapped)
+            chunk = numpy.frombuffer(mapped, dtype=numpy.int16).reshape(CHUNK_SAMPLES, self.tracks)
+            chunk[:] = 0  # fault in every page now, not during playout
+            self.chunks.append(chunk)
+            grown = True
+        if grown and end:
+            self.fh.seek(0)
+            self.fh.write(self.header(end))
+            self.fh.flush()
+
+    def run(self):
+        while not self.stopped:
+            self.grow_event.wait()
+            self.grow_event.clear()
+            if not self.stopped:
+                self.grow()
+
+    def write(self, sample_index, names, frames, mix):
+        """Called from Player.callback: frames[i] is what names[i] played
+        at sample_index, and mix is what came out of the speakers."""
+        (chunk_idx, offset) = divmod(sample_index, CHUNK_SAMPLES)
+        chunks = self.chunks
+        chunk = chunks[chunk_idx] if chunk_idx < len(chunks) else None
+        if chunk is None:
+            self.dropped += 1
+            self.grow_event.set()
+            return
+        block = chunk[offset : offset + 120]
+        block[:, 0] = audio.numpyify(mix)
+        for name, frame in zip(names, frames):
+            track = self.names.get(name)
+            if track is None:
+                if len(self.names) == self.tracks:
+                    self.untracked.add(name)
+                    continue
+                track = self.names[name] = len(self.names)
+            block[:, track] = audio.numpyify(frame)
+        if sample_index + 120 > self.end:
+            if (sample_index + 120) // CHUNK_SAMPLES != self.end // CHUNK_SAMPLES:
+                self.grow_event.set()
+            self.end = sample_index + 120
+
+    def stop(self, block=True):
+        self.stopped = True
+        self.grow_event.set()
+        if block:
+            self.thread.join()
+        del self.chunks[:]
+        for mapped in self.maps:
+            if mapped:
+                mapped.close()
+        self.fh.truncate(HEADER_SIZE + self.end * self.frame_bytes)
+        self.fh.seek(0)
+        self.fh.write(self.header(self.end))
+        self.fh.close()
+        with open(self.path + '.tracks', 'w') as fh:
+            for name, track in sorted(self.names.items(), key=lambda item: item[1]):
+                fh.write('{}\t{}\n'.format(track, name))
+        if self.dropped:
+            logging.warning('multitrack dropped {} frames'.format(self.dropped))
+        if self.untracked:
+            logging.warning('multitrack had no track for {}'.format(', '.join(sorted(self.untracked))))
@@ -5,7 +5,6 @@ import logging
 import queue
 import random
 import socket
-import struct
 import threading
 import time
 
@@ -13,17 +12,74 @@ import stats
 import util
 
 
+RECV_SIZE = 65536
+
 TIME_OFFSET = random.random()
 def offset_time():
     return time.time() + TIME_OFFSET
 
 
+FRAME_MS = 5
+MAX_BUNDLE = 4  # frames per datagram
+REDUNDANCY = 2  # already-sent frames repeated in each datagram
+BUNDLE_FORMAT = 1  # leading byte; can't be mistaken for JSON's '{'
+
+
+def pack_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def unpack_varint(data, idx):
+    value = shift = 0
+    while True:
+        byte = data[idx]
+        idx += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, idx
+        shift += 7
+
+
+def pack_bundle(first_seq, frames):
+    """Pack consecutive frames, starting at `first_seq`, into a datagram:
+    format byte, varint first seq, then a varint length before each frame."""
+    parts = [bytes((BUNDLE_FORMAT,)), pack_varint(first_seq)]
+    for frame in frames:
+        parts.append(pack_varint(len(frame)))
+        parts.append(frame)
+    return b''.join(parts)
+
+
+def unpack_bundle(data):
+    """Return the [(seq, frame)] in a datagram made by pack_bundle."""
+    if data[0] != BUNDLE_FORMAT:
+        raise ValueError('unknown packet format {}'.format(data[0]))
+    (seq, idx) = unpack_varint(data, 1)
+    payloads = []
+    while idx < len(data):
+        (size, idx) = unpack_varint(data, idx)
+        payloads.append((seq, data[idx : idx+size]))
+        idx += size
+        seq += 1
+    return payloads
+
+
 class Peer:
     def __init__(self, name, addr):
         self.name = name
         self.addrs = [addr]
         self.mindiff = -1e10
         self.maxdiff = 1e10
+        self.rtt = None  # smoothed, in ms
+        self.rtt_dev = 0.0
+        self.loss = 0.0  # smoothed fraction of pings not answered
+        self.awaiting_pong = False
+        self.unsent = 0  # frames broadcast since the last datagram to this peer
 
     @property
     def addr(self):
@@ -35,22 +91,93 @@ class Peer:
     def remove(self, addr):
         self.addrs.remove(addr)
 
+    def sent_ping(self):
+        self.loss = 0.9 * self.loss + (0.1 if self.awaiting_pong else 0.0)
+        self.awaiting_pong = True
+
     def receive_pong(self, payload):
         now = offset_time()
         ping_time = payload.get('ping_time')
         pong_time = payload.get('time')
         if not (ping_time or pong_time):
             return
-        stats.METER(
-            'RT {}'.format(self.name),
-            1000 * (now - ping_time),
-        )
+        self.awaiting_pong = False
+        rtt = 1000 * (now - ping_time)
+        stats.METER('RT {}'.format(self.name), rtt)
+        if self.rtt is None:
+            # Unlike TCP, don't assume the worst: that would bundle every
+            # link until enough 1 Hz pings had shown it was steady.
+            self.rtt = rtt
+            self.rtt_dev = 0.0
+        else:  # as for TCP's SRTT and RTTVAR
+            self.rtt_dev = 0.75 * self.rtt_dev + 0.25 * abs(self.rtt - rtt)
+            self.rtt = 0.875 * self.rtt + 0.125 * rtt
         self.mindiff = max(self.mindiff, pong_time - now)
         self.maxdiff = min(self.mindiff, pong_time - ping_time)
 
     def to_local_offset_time(self, peer_time):
         return peer_time - (self.mindiff + self.maxdiff) * 0.5
 
+    @property
+    def bundle_size(self):
+        """How many frames to send per datagram to this peer.
+
+        Where RTT varies by more than a frame or two, queuing on the link
+        already costs more than waiting to fill a bundle does, so trade
+        packet rate for up to MAX_BUNDLE frames of delay. A lost bundle
+        loses all of its new frames, so under loss stay small enough for
+        the redundant frames to cover one lost datagram."""
+        if self.rtt is None:
+            return 1
+        size = min(1 + int(self.rtt_dev / FRAME_MS), MAX_BUNDLE)
+        if self.loss > 0.05:
+            size = min(size, REDUNDANCY)
+        return size
+
+
+class PeerTable:
+    """The relay's roster as last seen, kept current from versioned pongs.
+
+    `names` maps addr -> name. It is replaced rather than mutated whenever
+    membership changes, so other threads can iterate it without a lock.
+
+    Snapshots arrive in pages; while `cursor` is set, pings ask for the
+    page after it, and `names` keeps the old roster until the last page.
+    The result is as of the first page's version, and any changes since
+    come in as deltas on top of it."""
+
+    def __init__(self):
+        self.version = None
+        self.names = {}
+        self.pending = None  # (version, names) of a snapshot in progress
+        self.cursor = None
+
+    def update(self, payload):
+        version = payload.get('version')
+        if 'clients' in payload:
+            if 'after' not in payload:
+                self.pending = (version, {})
+            elif not self.pending or tuple(payload['after']) != self.cursor:
+                return  # a page for some other request, e.g. reordered
+            (version, names) = self.pending
+            for cli in payload['clients']:
+                names[tuple(cli['addr'])] = cli['name']
+            if 'next' in payload:
+                self.cursor = tuple(payload['next'])
+                return
+            self.names = names
+            self.pending = self.cursor = None
+        elif payload.get('since') != self.version:
+            return  # a delta against some other version, e.g. reordered
+        elif payload.get('joined') or payload.get('left'):
+            names = dict(self.names)
+            for addr in payload.get('left', ()):
+                names.pop(tuple(addr), None)
+            for cli in payload.get('joined', ()):
+                names[tuple(cli['addr'])] = cli['name']
+            self.names = names
+        self.version = version
+
 
 class Listener:
     def __init__(self, client):
@@ -81,14 +208,14 @@ class Client:
         self.seq_lock = threading.Lock()
         self.listeners = [] 
         self.raw_listeners = []
-        self.known_peers = []
+        self.known_peers = PeerTable()
 
         self.peers = {}  # name -> Peer
         self.addrmap = {}  # addr -> name
         self.set_assoc('relay', relay_addr)
 
         self.broadcast_seq = 0
-        self.payloads = collections.deque()
+        self.frames = collections.deque(maxlen=MAX_BUNDLE + REDUNDANCY)
         self.tempo = None
         util.start_daemon(self.read_loop)
         util.start_daemon(self.ping_loop)
@@ -122,12 +249,30 @@ class Client:
             return self.seq
 
     def prepare_broadcast(self, data):
+        """Add a frame, and return [(addr, datagram)] for every peer whose
+        bundle is now full."""
         self.broadcast_seq += 1
-        payload = struct.pack('!II', self.broadcast_seq, len(data)) + data
-        self.payloads.appendleft(payload)
-        if len(self.payloads) > 3:
-            self.payloads.pop()
-        return b''.join(self.payloads)
+        self.frames.append(data)
+        bundles = {}  # frames per datagram -> datagram
+        prepared = []
+        for name in self.known_peers.names.values():
+            if name == self.name:
+                continue
+            peer = self.peers.get(name)
+            if not peer:
+                continue
+            peer.unsent += 1
+            size = peer.bundle_size
+            if peer.unsent < size:
+                continue
+            peer.unsent = 0
+            datagram = bundles.get(size)
+            if datagram is None:
+                count = min(size + REDUNDANCY, len(self.frames))
+                frames = list(self.frames)[-count:]
+                datagram = bundles[size] = pack_bundle(self.broadcast_seq - count + 1, frames)
+            prepared.append((peer.addr, datagram))
+        return prepared
 
     def broadcast_unreliably(self, data):
         if not getattr(self, 'delay_thread', None):
@@ -137,7 +282,10 @@ class Client:
             self.delay_thread = util.start_daemon(self.broadcast_delayed)
             self.dropped = False
         send_time = time.time() + random.expovariate(40)  # average 25 ms
-        item = (send_time, self.prepare_broadcast(data))
+        prepared = self.prepare_broadcast(data)
+        if not prepared:
+            return
+        item = (send_time, prepared)
         with self.delay_heap_lock:
             heapq.heappush(self.delay_heap, item)
             if random.random() < 0.01:  # dupe 1% of packets
@@ -154,26 +302,21 @@ class Client:
                 self.delay_heap_change.clear()
             wait = send_time - time.time()
             if wait <= 0:
+                with self.delay_heap_lock:
+                    heapq.heappop(self.delay_heap)
                 # drop 5% of all packets, but re-roll die only 75% of the time
                 if random.random() < 0.75:
                     self.dropped = (random.random() < 0.05)
                 if not self.dropped:
                     self.broadcast(data, prepared=True)
-                    with self.delay_heap_lock:
-                        heapq.heappop(self.delay_heap)
             else:
                 self.delay_heap_change.wait(timeout=wait)
 
     def broadcast(self, data, prepared=False):
         if not prepared:
             data = self.prepare_broadcast(data)
-        for peer in self.known_peers:
-            name = peer['name']
-            if name == self.name:
-                continue
-            addr = self.get_addr(name)
-            if addr:
-                self.sock.sendto(data, addr)
+        for (addr, datagram) in data:
+            self.sock.sendto(datagram, addr)
 
     def send(self, msg, addr):
         payload = json.dumps(msg).encode('ascii')
@@ -242,13 +385,14 @@ class Client:
         relay_addr = self.get_addr('relay')
         while True:
             time.sleep(1)
-            for peer in [{'name': 'relay'}] + self.known_peers:
-                name = peer['name']
+            peers = [(relay_addr, 'relay')]
+            peers.extend(self.known_peers.names.items())
+            for peer_addr, name in peers:
                 if name == self.name:
                     continue
                 addr = self.get_addr(name)
                 if not addr:
-                    addr = tuple(peer['addr'])
+                    addr = peer_addr
                     logging.info("trying to reach " + name)
                 msg = {
                     'type': 'ping',
@@ -256,6 +400,12 @@ class Client:
                     'seq': self.next_seq(),
                     'time': offset_time(),
                 }
+                if name == 'relay':
+                    msg['version'] = self.known_peers.version
+                    if self.known_peers.cursor:
+                        msg['after'] = self.known_peers.cursor
+                elif name in self.peers:
+                    self.peers[name].sent_ping()
                 if self.tempo:
                     msg['tempo'] = self.tempo
                 self.send(msg, addr)
@@ -285,13 +435,13 @@ class Client:
 
     def receive_pong(self, payload, peer):
         if peer == 'relay':
-            self.known_peers = payload['clients']
+            self.known_peers.update(payload)
         else:
             self.peers[peer].receive_pong(payload)
 
     def read_loop(self):
         while True:
-            data, addr = self.sock.recvfrom(1024)
+            data, addr = self.sock.recvfrom(RECV_SIZE)
             if data[0] != 0x7b or data[-1] != 0x7d:
                 self.dispatch_binary(data, addr)
                 continue
@@ -304,13 +454,11 @@ class Client:
             self.dispatch(payload, name)
 
     def dispatch_binary(self, data, addr):
-        payloads = []
-        idx = 0
-        while idx < len(data):
-            (seq, size) = struct.unpack('!II', data[idx : idx+8])
-            idx += 8
-            payloads.append((seq, data[idx : idx+size]))
-            idx += size
+        try:
+            payloads = unpack_bundle(data)
+        except (IndexError, ValueError):
+            stats.COUNT('bad packet')
+            return
         name = self.get_name(addr)
         if name is not None:
             for listener in self.raw_listeners:
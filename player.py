@@ -6,102 +6,231 @@ import time
 
 import numpy
 import opuslib
-import pyaudio
 
 import audio
+import deadline
 import stats
 import util
 
 
+IDLE_TIME = 5  # seconds without packets before a channel stops playing
+RETIRE_TIME = 30  # ... and before its thread and decoder are reclaimed
+HOUSEKEEPING_INTERVAL = 1
+MAX_PACKETS = 400  # per channel; the oldest are dropped past this
+DECODER_POOL_SIZE = 8
+
+# Burst recovery. After MAX_CONCEALED missing frames in a row, concealment
+# stops advancing the playout position, so packets held up by a stall are
+# still playable when they turn up; and when the buffer gets
+# RECOVERY_THRESHOLD frames (by default) past its target, the backlog is
+# decoded in batches and played two frames per callback until it's back
+# down to target.
+MAX_CONCEALED = 8
+MIN_DEPTH = 2  # frames
+TARGET_JITTERS = 3  # target depth, in multiples of the peer's jitter
+RECOVERY_THRESHOLD = 8  # frames
+RECOVERY_BATCH = 8  # frame pairs decoded and compressed at once
+QUIET_LEVEL = 64  # a frame peaking below this is skipped rather than mixed
+
+
 class Player:
-    def __init__(self):
+    def __init__(self, clock=time.time, threaded=True, recovery_threshold=RECOVERY_THRESHOLD):
+        """With threaded=False, channels get no decoder threads, and whoever
+        drives the callbacks must call Channel.decode_next() in between, and
+        housekeep() every so often. recovery_threshold=float('inf') turns
+        burst recovery off."""
         self.channels = {}
+        self.active = ((), ())  # (names, channels) the callback plays
+        self.membership_lock = threading.Lock()
+        self.decoders = []  # pool of idle opuslib.Decoders
+        self.clock = clock
+        self.threaded = threaded
+        self.recovery_threshold = recovery_threshold
+        self.sample_index = 0  # of the next callback's first sample
+        self.tap = None  # e.g. MultitrackWriter.write
+        self.monitor = deadline.Monitor('play')
 
     def start(self):
         self.stream = audio.get_audio().open(
-            format=pyaudio.paInt16,
+            format=audio.PA_INT16,
             channels=1,
             rate=24000,
             output=True,
             frames_per_buffer=120,
-            stream_callback=self.callback,
+            stream_callback=self.monitor.wrap(self.callback),
         )
+        if self.threaded:
+            util.start_daemon(self.run_housekeeping)
 
     def stop(self, block=True):
         self.stream.stop_stream()
         self.stream.close()
+        self.monitor.stop()
 
     def put_payloads(self, payloads, peer_name):
         channel = self.channels.get(peer_name)
-        if not channel:
-            # in lieu of a lock, use attribute assignment to synchronize
-            channels = dict(self.channels)
-            channels[peer_name] = channel = Channel()
-            self.channels = channels
+        if not channel or not channel.active:
+            channel = self.activate(peer_name)
         for (seq, data) in payloads:
             channel.enqueue(seq, data)
 
+    def activate(self, peer_name):
+        with self.membership_lock:
+            channel = self.channels.get(peer_name)
+            if not channel:
+                # readers don't lock, so replace the dict rather than mutate it
+                channels = dict(self.channels)
+                channels[peer_name] = channel = Channel(
+                    self.clock, self.threaded, self.get_decoder(), self.recovery_threshold)
+                self.channels = channels
+                receive_stats = channel.receive_stats
+                stats.GAUGE('recv % {}'.format(peer_name), lambda: receive_stats.receive_rate * 100)
+                stats.GAUGE('jitter {}'.format(peer_name), lambda: receive_stats.jitter * 1000)
+            if not channel.active:
+                channel.active = True
+                self.update_active()
+            return channel
+
+    def update_active(self):
+        active = [(name, channel) for name, channel in self.channels.items() if channel.active]
+        self.active = (
+            tuple(name for name, _ in active),
+            tuple(channel for _, channel in active),
+        )
+
+    def get_decoder(self):
+        if self.decoders:
+            decoder = self.decoders.pop()
+            decoder.reset_state()
+            return decoder
+        return opuslib.Decoder(24000, 1)
+
+    def run_housekeeping(self):
+        while True:
+            time.sleep(HOUSEKEEPING_INTERVAL)
+            self.housekeep()
+
+    def housekeep(self):
+        """Stop playing idle channels, and retire long-idle ones.
+
+        Retired channels are dropped under membership_lock, but their
+        decoder threads are joined after it is released, so packet intake
+        for everyone else doesn't wait on them."""
+        now = self.clock()
+        retired = []
+        with self.membership_lock:
+            changed = False
+            for name, channel in self.channels.items():
+                if not channel.last_packet_time:
+                    continue
+                idle = now - channel.last_packet_time
+                if channel.active and idle > IDLE_TIME:
+                    channel.active = False
+                    changed = True
+                if idle > RETIRE_TIME:
+                    retired.append((name, channel))
+            if retired:
+                channels = dict(self.channels)
+                for name, _ in retired:
+                    del channels[name]
+                    stats.UNGAUGE('recv % {}'.format(name))
+                    stats.UNGAUGE('jitter {}'.format(name))
+                self.channels = channels
+            if changed:
+                self.update_active()
+        for _, channel in retired:
+            self.retire(channel)
+
+    def retire(self, channel):
+        """Stop a channel that's out of self.channels, and pool its decoder
+        once its thread has finished with it."""
+        channel.retire()
+        busy = channel.decoder_thread and channel.decoder_thread.is_alive()
+        if not busy and len(self.decoders) < DECODER_POOL_SIZE:
+            self.decoders.append(channel.decoder)
+        stats.COUNT('retired')
+
     def callback(self, in_data, frame_count, time_info, status):
-        now = time.time()
-        frames = [
-            channel.get_audio()
-            for channel in self.channels.values()
-            if channel.last_packet_time and now - channel.last_packet_time < 5
-        ]
+        (names, channels) = self.active
+        frames = [channel.get_audio() for channel in channels]
         frame = audio.mix(frames)
         if isinstance(frame, numpy.ndarray) and frame.dtype != numpy.int16:
             frame = frame.astype(numpy.int16)
-        return (frame, pyaudio.paContinue)
+        if self.tap:
+            self.tap(self.sample_index, names, frames, frame)
+        self.sample_index += frame_count
+        return (frame, audio.PA_CONTINUE)
 
 
-Packet = collections.namedtuple('Packet', ['seq', 'data'])
+# A decoded packet may stand for `span` seqs, ending with `seq`.
+Packet = collections.namedtuple('Packet', ['seq', 'data', 'span'], defaults=(1,))
 
 class Channel:
     __slots__ = (
         'accept_rate',
+        'active',
+        'backlog',
+        'clock',
+        'concealed',
         'decoded',
         'decoder',
         'decoder_lock',
         'decoder_thread',
-        'dupe_check',
         'heap',
         'heap_lock',
         'last_missing',
         'last_packet_time',
         'last_played',
+        'missing_run',
         'ready_next_rate',
         'ready_rate',
+        'receive_stats',
+        'recovering',
+        'recovery_threshold',
+        'retired',
         'wake_event',
         'wake_lock',
     )
 
-    def __init__(self):
+    def __init__(self, clock=time.time, threaded=True, decoder=None, recovery_threshold=RECOVERY_THRESHOLD):
         self.accept_rate = 1.0
+        self.active = False  # whether Player.callback plays it
+        self.retired = False
+        self.clock = clock
         self.ready_rate = 1.0
         self.ready_next_rate = 0.0
         self.decoded = None
-        self.decoder = opuslib.Decoder(24000, 1)
+        self.decoder = decoder or opuslib.Decoder(24000, 1)
         self.decoder_lock = threading.Lock()
-        self.dupe_check = util.DupeCheck()
+        self.receive_stats = util.ReceiveStats()
         self.heap = []
         self.heap_lock = threading.Lock()
         self.last_packet_time = None
         self.wake_event = threading.Event()
         self.wake_lock = threading.Lock()
-        self.decoder_thread = util.start_daemon(self.run_decoder)
+        self.decoder_thread = util.start_daemon(self.run_decoder) if threaded else None
         self.last_missing = False
         self.last_played = None
+        self.missing_run = 0
+        self.concealed = 0  # frames played as concealment, in all
+        self.backlog = collections.deque()  # decoded, compressed Packets
+        self.recovering = False
+        self.recovery_threshold = recovery_threshold
 
     def enqueue(self, seq, data):
         """Enqueue a packet with its sequence number, and wake the decoder."""
-        self.last_packet_time = time.time()
-        if not self.dupe_check.receive(seq):
+        self.last_packet_time = self.clock()
+        seq = self.receive_stats.receive(seq, self.last_packet_time)
+        if seq is None:
             return
-        #stats.METER('recv %', self.dupe_check.receive_rate * 100)
         self.accept_rate *= 0.995
         if not self.last_played or seq > self.last_played:
             with self.heap_lock:
-                heapq.heappush(self.heap, Packet(seq, data))
+                if len(self.heap) < MAX_PACKETS:
+                    heapq.heappush(self.heap, Packet(seq, data))
+                else:
+                    heapq.heappushpop(self.heap, Packet(seq, data))  # drop oldest
+                    stats.COUNT('overflow')
             self.accept_rate += 0.005
             self.wake_event.set()
         #stats.METER('accept', self.accept_rate)
@@ -127,35 +256,121 @@ class Channel:
         stats.METER('readynext', self.ready_next_rate)
         return packet
 
+    def dequeue_run(self, count):
+        """Dequeue up to `count` consecutive packets after last_played."""
+        run = []
+        with self.heap_lock:
+            while self.heap and self.heap[0].seq <= self.last_played:
+                heapq.heappop(self.heap)
+            while self.heap and len(run) < count and self.heap[0].seq == self.last_played + 1 + len(run):
+                run.append(heapq.heappop(self.heap))
+        return run
+
+    def target_depth(self):
+        frames = self.receive_stats.jitter / self.receive_stats.frame_time
+        return max(MIN_DEPTH, int(TARGET_JITTERS * frames) + 1)
+
+    def excess_depth(self):
+        """Frames to drop to get back to the target depth, once the buffer
+        has overshot it by recovery_threshold; zero otherwise."""
+        if not self.last_played:
+            return 0
+        with self.heap_lock:
+            while self.heap and self.heap[0].seq <= self.last_played:
+                heapq.heappop(self.heap)  # stale, e.g. played as concealment
+            depth = len(self.heap) + len(self.backlog)
+        target = self.target_depth()
+        if not self.recovering and depth > target + self.recovery_threshold:
+            self.recovering = True
+            stats.COUNT('recover')
+        elif self.recovering and depth <= target:
+            self.recovering = False
+        return depth - target if self.recovering else 0
+
     def run_decoder(self):
-        while True:
+        while not self.retired:
             self.wake_event.wait()
             self.wake_event.clear()
-            if self.decoded:
-                continue
-            packet = self.dequeue()
-            if not packet:
-                continue  # out of luck! sleep until more data comes
-
-            self.decoder_lock.acquire()
-            if self.last_played and packet.seq <= self.last_played:
-                # too late; missed the callback window
-                with self.wake_lock:
-                    self.decoder_lock.release()
-                    self.wake_event.clear()
-                continue
-            if self.last_missing:
-                one = self.decoder.decode(b'', 120)
-                two = self.decoder.decode(packet.data, 120)
-                data = audio.crossfade(one, two)
-                self.last_missing = False
+            if self.retired:
+                break
+            self.decode_next()
+
+    def retire(self):
+        """Stop the decoder thread; the channel mustn't be used again."""
+        self.retired = True
+        self.wake_event.set()
+        if self.decoder_thread:
+            self.decoder_thread.join(timeout=1)
+
+    def decode_next(self):
+        """Fill the decoded buffer, if it's empty: from the backlog of
+        compressed frames if there is one, else from the heap."""
+        if self.decoded:
+            return
+        while self.backlog and self.last_played and self.backlog[0].seq - self.backlog[0].span < self.last_played:
+            self.backlog.popleft()
+        if self.backlog:
+            packets = None
+            packet = self.backlog.popleft()
+        else:
+            excess = self.excess_depth()
+            if excess > 1:
+                packets = self.dequeue_run(2 * min(excess // 2, RECOVERY_BATCH))
             else:
-                data = self.decoder.decode(packet.data, 120)
-            self.wake_lock.acquire()
-            self.decoded = Packet(packet.seq, data)
-            self.decoder_lock.release()
-            self.wake_event.clear()
-            self.wake_lock.release()
+                packets = [self.dequeue()]
+            if not packets or not packets[0]:
+                return  # out of luck! sleep until more data comes
+            packet = packets[0]
+
+        self.decoder_lock.acquire()
+        if self.last_played and packet.seq - packet.span < self.last_played:
+            # too late; missed the callback window
+            with self.wake_lock:
+                self.decoder_lock.release()
+                self.wake_event.clear()
+            return
+        if packets and len(packets) > 1:
+            packet = self.decode_run(packets)
+        elif packets and self.last_missing:
+            one = self.decoder.decode(b'', 120)
+            two = self.decoder.decode(packet.data, 120)
+            packet = Packet(packet.seq, audio.crossfade(one, two))
+            self.last_missing = False
+        elif packets:
+            packet = Packet(packet.seq, self.decoder.decode(packet.data, 120))
+        self.wake_lock.acquire()
+        self.decoded = packet
+        self.decoder_lock.release()
+        self.wake_event.clear()
+        self.wake_lock.release()
+
+    def decode_run(self, packets):
+        """Decode consecutive packets into half as many frames, queue all but
+        the first in the backlog, and return that.
+
+        Each pair of frames becomes one: whichever is audible if the other
+        is quiet, or else the two overlap-added with a crossfade."""
+        frames = numpy.empty((len(packets), 120), dtype=numpy.int16)
+        concealed = None
+        if self.last_missing:  # as in decode_next, conceal before decoding on
+            concealed = self.decoder.decode(b'', 120)
+            self.last_missing = False
+        for idx, packet in enumerate(packets):
+            frames[idx] = audio.numpyify(self.decoder.decode(packet.data, 120))
+        if concealed is not None:
+            frames[0] = audio.crossfade(concealed, frames[0])
+        pairs = len(packets) // 2
+        (one, two) = (frames[0 : 2*pairs : 2], frames[1 : 2*pairs : 2])
+        quiet = (frames.max(axis=1) < QUIET_LEVEL) & (frames.min(axis=1) > -QUIET_LEVEL)
+        (one_quiet, two_quiet) = (quiet[0 : 2*pairs : 2, None], quiet[1 : 2*pairs : 2, None])
+        mixed = one * audio.FADE_OUT + two * audio.FADE_IN
+        out = numpy.where(one_quiet, two, numpy.where(two_quiet, one, mixed)).astype(numpy.int16)
+        decoded = [Packet(packets[2*idx + 1].seq, out[idx], 2) for idx in range(pairs)]
+        if len(packets) % 2:
+            decoded.append(Packet(packets[-1].seq, frames[-1]))
+        self.backlog.extend(decoded[1:])
+        stats.COUNT('compressed', pairs)
+        return decoded[0]
 
     def read_decoded(self):
         """Return whatever is in the decoded buffer (possibly None) and wake
@@ -190,16 +405,33 @@ class Channel:
             self.last_missing = True
             self.decoder_lock.release()
             stats.COUNT('missing')
-            self.last_played += 1
-            self.adjust_buffer()
+            self.concealed += 1
+            self.missing_run += 1
+            if self.missing_run <= MAX_CONCEALED:
+                self.last_played += 1
+                self.adjust_buffer()
+            else:
+                self.skip_gap()
             return data
         else:
+            self.decoder_lock.release()
             return audio.SILENCE
 
+    def skip_gap(self):
+        """While holding position, move past seqs that are lost for good,
+        i.e. that later packets have overtaken."""
+        with self.heap_lock:
+            if not self.heap:
+                return
+            next_seq = self.heap[0].seq
+        if next_seq > self.last_played + 1:
+            self.last_played = next_seq - 1
+
     def should_play(self, packet):
-        if not packet or (self.last_played and packet.seq != self.last_played + 1):
+        if not packet or (self.last_played and packet.seq - packet.span != self.last_played):
             return False
         self.last_played = packet.seq
+        self.missing_run = 0
         return True
 
     def adjust_buffer(self):
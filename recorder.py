@@ -1,9 +1,9 @@
 import logging
 
 import opuslib
-import pyaudio
 
 import audio
+import deadline
 
 
 class Recorder:
@@ -14,20 +14,22 @@ class Recorder:
         self.enc.packet_loss_perc = 25
         self.enc.signal = opuslib.SIGNAL_MUSIC
         self.listeners = []
+        self.monitor = deadline.Monitor('record')
 
     def start(self):
         self.stream = audio.get_audio().open(
-            format=pyaudio.paInt16,
+            format=audio.PA_INT16,
             channels=1,
             rate=24000,
             input=True,
             frames_per_buffer=120,
-            stream_callback=self.callback,
+            stream_callback=self.monitor.wrap(self.callback),
         )
 
     def stop(self, block=True):
         self.stream.stop_stream()
         self.stream.close()
+        self.monitor.stop()
 
     def callback(self, in_data, frame_count, time_info, status):
         if frame_count == 120:
@@ -36,6 +38,6 @@ class Recorder:
                 listener(data)
         else:
             logging.warn("Incorrect input frame count {}".format(frame_count))
-        return (None, pyaudio.paContinue)
+        return (None, audio.PA_CONTINUE)
 
 
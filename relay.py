@@ -1,48 +1,256 @@
+import bisect
+import collections
 import json
+import multiprocessing
+import multiprocessing.managers
+import signal
 import socket
+import sys
+import threading
 import time
 
 
-#outbound = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+PORT = 5005
+STALE_TIME = 15  # seconds without a ping before a client is forgotten
+PRUNE_INTERVAL = 5
+SYNC_INTERVAL = 0.5  # how stale a worker's view of the roster may get
+LOG_SIZE = 4096  # roster changes kept for clients catching up
+MAX_REPLY_BYTES = 1200  # keeps any reply within one unfragmented datagram
+ROSTER_BYTES = MAX_REPLY_BYTES - 100  # of that, for clients; the rest is other fields
 
-CLIENTS = {}
 
-def list_clients():
-    now = time.time()
-    if now - getattr(list_clients, 'last_prune_time', 0) > 5:
-        stale = [addr for addr, cli in CLIENTS.items() if now - cli['last_ping'] > 15]
-        for addr in stale:
-            del CLIENTS[addr]
-        list_clients.last_prune_time = now
-    return [
-        {'name': cli['name'], 'addr': addr} for addr, cli in CLIENTS.items()
-    ]
+class Store:
+    """Roster state shared by all relay workers, keyed by client address.
 
+    With a single worker this lives in-process; with several, it is served
+    by a RosterManager and every call is a round trip, so workers batch
+    their writes and cache their reads (see Relay).
 
-def handle_msg(body, addr):
-    msgtype = body['type']
-    if msgtype == 'enter':
-        name = body['from']
-        CLIENTS[addr] = {'name': name, 'last_ping': time.time()}
-        return {'youare': addr, 'clients': list_clients()}
-    if msgtype == 'ping':
-        if addr in CLIENTS:
-            CLIENTS[addr]['last_ping'] = time.time()
-        return {'type': 'pong', 'clients': list_clients()}
-    if msgtype == 'leave':
-        CLIENTS.pop(addr, None)
-        return {}
+    Every join or leave bumps the version by one and is appended to a
+    bounded log, so anyone holding an older version can catch up from the
+    log instead of re-reading the whole roster.
 
+    The manager serves each worker's connection on its own thread, so
+    every method holds `lock`."""
 
-if __name__ == '__main__':
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}  # addr -> {'name', 'last_ping'}
+        self.last_prune_time = 0
+        self.version = 0
+        self.log = collections.deque(maxlen=LOG_SIZE)  # (version, addr, name or None)
+
+    def record(self, addr, name):
+        self.version += 1
+        self.log.append((self.version, addr, name))
+
+    def put(self, addr, name, now):
+        with self.lock:
+            cli = self.clients.get(addr)
+            if not cli or cli['name'] != name:
+                self.record(addr, name)
+            self.clients[addr] = {'name': name, 'last_ping': now}
+
+    def remove(self, addr):
+        with self.lock:
+            self.discard(addr)
+
+    def discard(self, addr):
+        if self.clients.pop(addr, None):
+            self.record(addr, None)
+
+    def touch(self, pings):
+        """Apply a batch of {addr: ping time}, ignoring unknown addrs."""
+        with self.lock:
+            for addr, now in pings.items():
+                cli = self.clients.get(addr)
+                if cli and cli['last_ping'] < now:
+                    cli['last_ping'] = now
+
+    def prune(self, now):
+        with self.lock:
+            self.prune_locked(now)
+
+    def prune_locked(self, now):
+        if now - self.last_prune_time > PRUNE_INTERVAL:
+            stale = [addr for addr, cli in self.clients.items() if now - cli['last_ping'] > STALE_TIME]
+            for addr in stale:
+                self.discard(addr)
+            self.last_prune_time = now
+
+    def snapshot(self, now):
+        with self.lock:
+            self.prune_locked(now)
+            return self.version, [(addr, cli['name']) for addr, cli in self.clients.items()]
+
+    def changes_since(self, version, now):
+        """Return (version, log entries after `version`), or None if the log
+        no longer reaches back that far."""
+        with self.lock:
+            self.prune_locked(now)
+            if version > self.version or (self.log and version < self.log[0][0] - 1):
+                return None
+            return self.version, [entry for entry in self.log if entry[0] > version]
+
+
+class RosterManager(multiprocessing.managers.BaseManager):
+    pass
+
+RosterManager.register('Store', Store)
+
+
+class Relay:
+    """Handles messages for one worker process.
+
+    A client's datagrams may land on any worker, so nothing here is
+    authoritative: enters and leaves are written through to the store at
+    once, pings are coalesced, and the roster served in replies is at most
+    SYNC_INTERVAL old.
+
+    Each worker mirrors the store's roster and change log, so a ping
+    carrying the client's last-seen version is answered with only the
+    joins and leaves since then.
+
+    Snapshots go out a page at a time, in addr order: a page that isn't
+    the last names the addr to continue `after`, which the client sends
+    with its next ping. Paging by key rather than by position means an
+    addr that stays in the roster can't be skipped when others come and
+    go in between."""
+
+    def __init__(self, store):
+        self.store = store
+        self.pending_pings = {}
+        self.roster = {}  # addr -> name
+        self.log = collections.deque(maxlen=LOG_SIZE)
+        self.version = None
+        self.synced = 0
+        self.replies = {}  # client version -> cached reply fields
+        self.sorted_roster = None  # [(addr, name)], built for paging
+
+    def sync(self, now):
+        if self.pending_pings:
+            self.store.touch(self.pending_pings)
+            self.pending_pings = {}
+        changes = None
+        if self.version is not None:
+            changes = self.store.changes_since(self.version, now)
+        if changes is None:
+            (self.version, clients) = self.store.snapshot(now)
+            self.roster = dict(clients)
+            self.log.clear()
+        else:
+            (self.version, entries) = changes
+            for (version, addr, name) in entries:
+                if name is None:
+                    self.roster.pop(addr, None)
+                else:
+                    self.roster[addr] = name
+            self.log.extend(entries)
+        self.replies = {}
+        self.sorted_roster = None
+        self.synced = now
+
+    def maybe_sync(self, force=False):
+        now = time.time()
+        if force or self.version is None or now - self.synced > SYNC_INTERVAL:
+            self.sync(now)
+
+    def list_clients(self):
+        return [{'name': name, 'addr': addr} for addr, name in self.roster.items()]
+
+    def snapshot_page(self, after=None):
+        if self.sorted_roster is None:
+            self.sorted_roster = sorted(self.roster.items())
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right(self.sorted_roster, (after, chr(0x10ffff)))
+        clients = []
+        size = 0
+        for (addr, name) in self.sorted_roster[start:]:
+            client = {'name': name, 'addr': addr}
+            size += len(json.dumps(client)) + 2
+            if clients and size > ROSTER_BYTES:
+                break
+            clients.append(client)
+        reply = {'version': self.version, 'clients': clients}
+        if after is not None:
+            reply['after'] = after
+        if start + len(clients) < len(self.sorted_roster):
+            reply['next'] = clients[-1]['addr']
+        return reply
+
+    def roster_reply(self, version, after=None):
+        """Roster fields for a client that last saw `version`: nothing if
+        it is current, the changes since then if the log still has them
+        and they fit, and a snapshot page otherwise."""
+        if after is not None:
+            return self.snapshot_page(tuple(after))
+        reply = self.replies.get(version)
+        if reply is not None:
+            return reply
+        if version == self.version:
+            reply = {'version': self.version}
+        elif version is not None and self.log and self.log[0][0] - 1 <= version < self.version:
+            # Too many changes for one reply only go as far as fit; the
+            # client catches up the rest from there on its next ping.
+            changes = {}
+            size = 0
+            reached = version
+            for (entry_version, addr, name) in self.log:
+                if entry_version <= version:
+                    continue
+                if addr not in changes:
+                    size += len(json.dumps({'name': name, 'addr': addr})) + 2
+                    if size > ROSTER_BYTES:
+                        break
+                changes[addr] = name
+                reached = entry_version
+            reply = {
+                'version': reached,
+                'since': version,
+                'joined': [{'name': name, 'addr': addr} for addr, name in changes.items() if name is not None],
+                'left': [addr for addr, name in changes.items() if name is None],
+            }
+        else:
+            reply = self.snapshot_page()
+        if len(self.replies) < LOG_SIZE:
+            self.replies[version] = reply
+        return reply
+
+    def handle_msg(self, body, addr):
+        msgtype = body['type']
+        if msgtype == 'enter':
+            self.store.put(addr, body['from'], time.time())
+            self.maybe_sync(force=True)
+            reply = {'youare': addr}
+            reply.update(self.roster_reply(None))
+            return reply
+        if msgtype == 'ping':
+            self.pending_pings[addr] = time.time()
+            self.maybe_sync()
+            reply = {'type': 'pong'}
+            reply.update(self.roster_reply(body.get('version'), body.get('after')))
+            return reply
+        if msgtype == 'leave':
+            self.pending_pings.pop(addr, None)
+            self.store.remove(addr)
+            self.maybe_sync(force=True)
+            return {}
+
+
+def serve(store, port=PORT, reuse_port=False, verbose=False):
+    relay = Relay(store)
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('0.0.0.0', 5005))
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('0.0.0.0', port))
     while True:
         data, addr = sock.recvfrom(1024)
-        print(addr, "->", data)
+        if verbose:
+            print(addr, "->", data)
         try:
             body = json.loads(data.decode('ascii'))
-            reply = handle_msg(body, addr)
+            reply = relay.handle_msg(body, addr)
             if reply is None:
                 continue
         except Exception:
@@ -50,4 +258,45 @@ if __name__ == '__main__':
         reply['from'] = 'relay'
         if 'seq' in body:
             reply['seq'] = body['seq']
-        sock.sendto(json.dumps(reply).encode('ascii'), addr)
+        try:
+            sock.sendto(json.dumps(reply).encode('ascii'), addr)
+        except OSError:
+            continue
+
+
+def run(workers=1, port=PORT, verbose=False):
+    if workers == 1:
+        serve(Store(), port, verbose=verbose)
+        return
+    manager = RosterManager()
+    manager.start()
+    store = manager.Store()
+    procs = [
+        multiprocessing.Process(target=serve, args=(store, port, True, verbose), daemon=True)
+        for _ in range(workers)
+    ]
+    for proc in procs:
+        proc.start()
+
+    def stop(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)  # after forking, so workers keep the default
+    try:
+        for proc in procs:
+            proc.join()
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.join()
+        manager.shutdown()
+
+
+if __name__ == '__main__':
+    workers = 1
+    if '--workers' in sys.argv:
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+    port = PORT
+    if '--port' in sys.argv:
+        port = int(sys.argv[sys.argv.index('--port') + 1])
+    run(workers, port, verbose='-v' in sys.argv)
@@ -0,0 +1,84 @@
+"""Replays a session capture through the jitter buffer on a virtual clock.
+
+Channels run without decoder threads, and each 5 ms tick feeds the packets
+that had arrived by then, decodes, and runs Player.callback, so a replay is
+deterministic and can run as fast as the decoder allows."""
+
+import collections
+import sys
+import time
+
+import capture
+import player
+
+
+TICK = 0.005
+DRAIN_TIME = 0.5  # keep playing this long after the last arrival
+HOUSEKEEPING_TICKS = int(player.HOUSEKEEPING_INTERVAL / TICK)
+
+
+class Replay:
+    def __init__(self, directory, recovery_threshold=player.RECOVERY_THRESHOLD):
+        datagrams = collections.defaultdict(list)  # (arrival, datagram, peer) -> payloads
+        for peer_name, records in capture.load_captures(directory).items():
+            for (arrival, seq, datagram, packet) in records:
+                datagrams[(arrival, datagram, peer_name)].append((seq, packet))
+        self.events = sorted(datagrams.items())
+        self.now = self.events[0][0][0] if self.events else 0.0
+        self.player = player.Player(
+            clock=self.clock, threaded=False, recovery_threshold=recovery_threshold)
+        self.listeners = []  # called with each mixed frame
+        self.ticks = 0
+        self.concealed = collections.Counter()  # peer name -> frames
+
+    def clock(self):
+        return self.now
+
+    def tick(self):
+        if self.ticks % HOUSEKEEPING_TICKS == 0:
+            self.player.housekeep()
+        for channel in self.player.channels.values():
+            channel.decode_next()
+        (names, channels) = self.player.active
+        before = [channel.concealed for channel in channels]
+        (frame, _) = self.player.callback(None, 120, None, 0)
+        for peer_name, channel, count in zip(names, channels, before):
+            if channel.concealed > count:
+                self.concealed[peer_name] += channel.concealed - count
+        for listener in self.listeners:
+            listener(frame)
+        self.ticks += 1
+        self.now += TICK
+
+    def run(self, speed=None):
+        """Replay everything; speed is a multiple of real time, or None to
+        go as fast as possible."""
+        if not self.events:
+            return
+        start_time = self.now
+        start_wall = time.time()
+        end_time = self.events[-1][0][0] + DRAIN_TIME
+        idx = 0
+        while self.now < end_time:
+            while idx < len(self.events) and self.events[idx][0][0] <= self.now:
+                ((_, _, peer_name), payloads) = self.events[idx]
+                self.player.put_payloads(payloads, peer_name)
+                idx += 1
+            self.tick()
+            if speed:
+                wait = start_wall + (self.now - start_time) / speed - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+
+
+if __name__ == '__main__':
+    speed = None
+    if '--speed' in sys.argv:
+        speed = float(sys.argv[sys.argv.index('--speed') + 1])
+    replay = Replay(sys.argv[1])
+    start = time.time()
+    replay.run(speed)
+    elapsed = time.time() - start
+    print('{} ticks ({:.1f} s of audio) in {:.1f} s'.format(replay.ticks, replay.ticks * TICK, elapsed))
+    for peer_name, count in sorted(replay.concealed.items()):
+        print('{}: {} frames concealed'.format(peer_name, count))
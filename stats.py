@@ -1,5 +1,6 @@
 import collections
 import logging
+import threading
 import time
 
 import util
@@ -7,10 +8,19 @@ import util
 
 class Stats:
     def __init__(self):
+        """The reporting thread starts with the first thing to report, or
+        with an explicit start()."""
         self.printing = True
-        self.thread = util.start_daemon(self.run)
+        self.gauges = {}  # key -> function, sampled at every report
+        self.thread = None
+        self.start_lock = threading.Lock()
         self.trackers = self.create_trackers()
 
+    def start(self):
+        with self.start_lock:
+            if not self.thread:
+                self.thread = util.start_daemon(self.run)
+
     def create_trackers(self):
         return (
             collections.Counter(),
@@ -18,11 +28,33 @@ class Stats:
         )
 
     def count(self, key, delta=1):
+        if not self.thread:
+            self.start()
         self.trackers[0][str(key)] += delta
 
     def meter(self, key, value):
+        if not self.thread:
+            self.start()
         self.trackers[1][key].append(value)
 
+    def gauge(self, key, func):
+        if not self.thread:
+            self.start()
+        gauges = dict(self.gauges)
+        gauges[key] = func
+        self.gauges = gauges
+
+    def ungauge(self, key):
+        gauges = dict(self.gauges)
+        gauges.pop(key, None)
+        self.gauges = gauges
+
+    @staticmethod
+    def format(value):
+        if value < 1000:
+            return '{:#.3g}'.format(value)
+        return str(value).split('.')[0]
+
     def run(self):
         prev_cols = None
         while True:
@@ -33,11 +65,9 @@ class Stats:
             for key, count in counters.items():
                 record['# ' + key] = str(count)
             for key, values in meters.items():
-                value = sum(values) / len(values)
-                if value < 1000:
-                    record['avg ' + key] = '{:#.3g}'.format(value)
-                else:
-                    record['avg ' + key] = str(value).split('.')[0]
+                record['avg ' + key] = self.format(sum(values) / len(values))
+            for key, func in self.gauges.items():
+                record[key] = self.format(func())
             if not record:
                 continue
             cols = sorted(record.keys())
@@ -53,3 +83,5 @@ class Stats:
 INSTANCE = Stats()
 COUNT = INSTANCE.count
 METER = INSTANCE.meter
+GAUGE = INSTANCE.gauge
+UNGAUGE = INSTANCE.ungauge
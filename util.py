@@ -2,44 +2,154 @@ import threading
 
 
 def start_daemon(func, *args):
-    thread = threading.Thread(target=func, args=args, daemon=True)
+    thread = threading.Thread(target=func, args=args, daemon=True, name=func.__qualname__)
     thread.start()
     return thread
 
 
-class DupeCheck:
-    """Detects duplicates in last 128 sequence numbers."""
-
-    # This class should really be written in C.
-    __slots__ = ('array', 'latest')
-    ZEROS = b'\0' * 128
-
-    def __init__(self):
-        self.array = bytearray(128)
-        self.latest = -1
-
-    def receive(self, seq):
-        if seq <= self.latest - 128:
-            return False  # too old
-        seq_idx = seq % 128
-        if seq > self.latest:
-            if seq >= self.latest + 128:
-                self.array[:] = DupeCheck.ZEROS
-            else:
-                latest_idx = self.latest % 128
-                if seq_idx > latest_idx:
-                    self.array[latest_idx + 1 : seq_idx + 1] = DupeCheck.ZEROS[latest_idx + 1 : seq_idx + 1]
-                else:
-                    self.array[latest_idx + 1:] = DupeCheck.ZEROS[latest_idx + 1:]
-                    self.array[:seq_idx + 1] = DupeCheck.ZEROS[:seq_idx + 1]
-            self.latest = seq
-        result = not self.array[seq_idx]
-        self.array[seq_idx] = 1
-        return result
+def popcount(value):
+    return bin(value).count('1')
+
+
+class ReceiveStats:
+    """Per-peer receive statistics in the spirit of RFC 3550, section 6.4.
+
+    Sequence numbers are taken modulo 2**32 and extended, so they keep
+    increasing across wraparound. The last `window` of them are tracked
+    in an int used as a bitset (bit i is extended seq `highest - i`),
+    and every statistic is updated in O(1) per packet (a jump costs one
+    step per received seq leaving the window, however far it goes)."""
+
+    __slots__ = (
+        'window',
+        'frame_time',
+        'full_mask',
+        'mask',
+        'highest',
+        'base',
+        'received',
+        'in_window',
+        'duplicates',
+        'too_old',
+        'jitter',
+        'last_transit',
+        'reordered',
+        'reorder_histogram',
+        'loss_run',
+        'unborn',
+        'burst_histogram',
+    )
+    SEQ_MOD = 1 << 32
+    HISTOGRAM_SIZE = 16  # the last bucket counts everything at least that big
+
+    def __init__(self, window=1024, frame_time=0.005):
+        self.window = window
+        self.frame_time = frame_time
+        self.full_mask = (1 << window) - 1
+        self.mask = 0
+        self.highest = None  # extended seq
+        self.base = None  # first extended seq
+        self.received = 0  # unique packets
+        self.in_window = 0  # bits set in mask
+        self.duplicates = 0
+        self.too_old = 0
+        self.jitter = 0.0  # seconds
+        self.last_transit = None
+        self.reordered = 0
+        self.reorder_histogram = [0] * self.HISTOGRAM_SIZE  # by distance behind highest
+        self.loss_run = 0  # missing seqs at the trailing edge of the window
+        self.unborn = window - 1  # window slots from before the first seq
+        self.burst_histogram = [0] * self.HISTOGRAM_SIZE  # by length of loss burst
+
+    def extend(self, seq):
+        if self.highest is None:
+            return seq
+        delta = (seq - self.highest) % self.SEQ_MOD
+        if delta >= self.SEQ_MOD // 2:
+            delta -= self.SEQ_MOD
+        return self.highest + delta
+
+    def receive(self, seq, arrival):
+        """Record a packet; return its extended seq, or None if it is a
+        duplicate or too old to tell."""
+        ext = self.extend(seq)
+        if self.highest is None:
+            self.highest = self.base = ext
+            self.mask = 1
+        elif ext > self.highest:
+            self.advance(ext - self.highest)
+            self.highest = ext
+            self.mask |= 1
+        else:
+            distance = self.highest - ext
+            if distance >= self.window:
+                self.too_old += 1
+                return None
+            bit = 1 << distance
+            if self.mask & bit:
+                self.duplicates += 1
+                return None
+            self.mask |= bit
+            self.reordered += 1
+            self.reorder_histogram[min(distance, self.HISTOGRAM_SIZE - 1)] += 1
+        self.received += 1
+        self.in_window += 1
+        transit = arrival - ext * self.frame_time
+        if self.last_transit is not None:
+            self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+        self.last_transit = transit
+        return ext
+
+    def advance(self, shift):
+        """Slide the window forward, settling the seqs that fall out of it."""
+        if shift == 1:  # the usual case
+            leaving = self.mask >> (self.window - 1)
+            self.in_window -= leaving
+            self.settle(leaving)
+            self.mask = (self.mask << 1) & self.full_mask
+            return
+        count = min(shift, self.window)
+        leaving = self.mask >> (self.window - count)  # bit count-1 is the oldest
+        self.in_window -= popcount(leaving)
+        while leaving:  # oldest first, the missing seqs between in bulk
+            top = leaving.bit_length() - 1
+            self.settle_missing(count - 1 - top)
+            self.settle(1)
+            leaving ^= 1 << top
+            count = top
+        self.settle_missing(count + shift - min(shift, self.window))  # and those skipped over entirely
+        self.mask = (self.mask << shift) & self.full_mask if shift < self.window else 0
+
+    def settle(self, seen):
+        if self.unborn:
+            self.unborn -= 1
+        elif not seen:
+            self.loss_run += 1
+        elif self.loss_run:
+            self.burst_histogram[min(self.loss_run, self.HISTOGRAM_SIZE - 1)] += 1
+            self.loss_run = 0
+
+    def settle_missing(self, count):
+        """settle(0), `count` times over."""
+        unborn = min(count, self.unborn)
+        self.unborn -= unborn
+        self.loss_run += count - unborn
 
     def saw(self, seq):
-        return self.latest - 128 < seq <= self.latest and bool(self.array[seq % 128])
+        ext = self.extend(seq)
+        distance = self.highest - ext if self.highest is not None else -1
+        return 0 <= distance < self.window and bool(self.mask >> distance & 1)
+
+    @property
+    def expected(self):
+        return 0 if self.highest is None else self.highest - self.base + 1
+
+    @property
+    def lost(self):
+        return self.expected - self.received
 
     @property
     def receive_rate(self):
-        return sum(self.array) / 128.0
+        """Fraction received of the last `window` seqs (or fewer, early on)."""
+        span = min(self.expected, self.window)
+        return self.in_window / span if span else 1.0